@@ -1,273 +1,499 @@
-from __future__ import annotations
-import os, re, json, pathlib
-from typing import List, Dict
-from rapidfuzz import process, fuzz  # type: ignore
-from openai import OpenAI  # type: ignore
-import langdetect
-
-# ─────── configuration ───────
-MODEL = "gpt-4o-mini"
-DB_DESC_FILE = pathlib.Path("instructions/db_description.txt")
-MAX_SCHEMA_LINES_IN_PROMPT = 120
-SIMILARITY_THRESHOLD = 80
-API_KEY = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=API_KEY)
-
-# ─────── 1.  Parse db_description.txt ───────
-# ─────── 1.  Parse db_description.txt ───────
-def _parse_db_description(path: pathlib.Path) -> Dict[str, List[str]]:
-    schema: Dict[str, List[str]] = {}
-    current_table = None
-
-    for raw in path.read_text(encoding="utf-8").splitlines():
-        tbl = re.match(r"^###\s+([A-Za-z0-9_]+)", raw)
-        if tbl:
-            current_table = tbl.group(1).lower()
-            schema[current_table] = []
-            continue
-
-        if current_table:
-            # NEW: прибираємо маркери ' - ' на початку
-            line = raw.lstrip(" \t-")
-            col = re.match(r"^([A-Za-z0-9_]+):", line)
-            if col:
-                schema[current_table].append(col.group(1).lower())
-
-    return schema
-
-_SCHEMA = _parse_db_description(DB_DESC_FILE)
-_FLAT_COLUMNS = [f"{tbl}.{col}" for tbl, cols in _SCHEMA.items() for col in cols]
-
-# ─────── 2.  Fast local “did‑you‑mean” search ───────
-def _fuzzy_suggest(text: str, k: int = 3) -> List[str]:
-    tokens = re.findall(r"[A-Za-z0-9_]{3,}", text.lower())
-
-    # 🔄 NEW: накопичуємо найкращий скор для кожного cand
-    best: dict[str, int] = {}
-    for tok in tokens:
-        for cand, score, _ in process.extract(
-            tok,
-            _FLAT_COLUMNS,
-            scorer=fuzz.partial_ratio,   # partial працює ліпше для «chocolate» vs products.name
-            limit=20,                    # ширше, ніж 3
-        ):
-            if score >= 65:              # ↓ трохи нижчий поріг
-                best[cand] = max(best.get(cand, 0), score)
-
-    # відсортуємо й віддамо top-k
-    return sorted(best, key=best.get, reverse=True)[:k]
-
-from datetime import datetime
-today = datetime.today().strftime("%Y-%m-%d")
-
-
-# ─────── 3.  Prompts and function spec ───────
-SYSTEM_PROMPT = f"""
-You are a router for a SQL chat assistant.
-
-You must *always* return a JSON object with the keys:
-  "route"        – "sql_query" or "clarify"
-  "reason"       – short explanation (match user language)
-  "suggestions"  – array of up to 3 table.column strings
- 
-
-Mandatory Rules
-===============
-• Choose **"sql_query"** when the question can be answered *using any column from the known tables*.  
-  ─ If the query mentions a word that fuzzy-matches ≥ 1 column (hint supplied below), treat it as data-related.  
-  ─ For “top N” / aggregate / date-filtered questions, proceed with SQL generation.
-• Choose **"clarify"** only when **none** of the known columns seem relevant **or** the question is clearly outside business/database context.
-• Never invent table or column names – use only those in the *Known tables* section.
-• If the user gives a vague time period (“this month”, “last year”, “last quarter”), translate it into a concrete date range based on today's date: {today}.
-  For example:
-  – “this month” → from the 1st of the current month to today
-  – “last month” → from the 1st to the last day of the previous month
-  – “last week” → from Monday to Sunday of the previous calendar week
-  – “this year” → from January 1st to today
-  – “last year” → January 1st to December 31st of previous year
-  If the time expression is ambiguous or nonstandard, ask the user for specific dates.
-
-Clarification Guidance
-======================
-• If the query names a **person, product, or store** but lacks an ID/slug, ask for a specific identifier (e.g. customer_id, product_id, store_id).  
-• If the query refers to a **time period** but does not specify concrete dates, ask the user to provide start/end dates.  
-• If multiple interpretations are possible, ask the *most critical* 1-2 follow-up questions to disambiguate.
-• If you choose "clarify", leave "suggestions" empty.
-
-Contextual Awareness
-====================
-• **customers** → `customers` table (customer-level info)  
-• **orders / order items** → `orders`, `order_items` (sales & quantities)  
-• **products & categories** → `products`  
-• **campaigns & budgets** → `campaigns`  
-• **inventory per store** → `inventory`, joined with `stores`  
-• **regions & stores** → `regions`, `stores`  
-(Use joins across these tables as needed.)
-
-Known tables/columns (truncated for context):
-{'; '.join(_FLAT_COLUMNS[:MAX_SCHEMA_LINES_IN_PROMPT])}
-""".strip()
-
-
-FUNCTION_SPEC = [
-    {
-        "type": "function",
-        "function": {
-            "name": "decide_action",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "route": {
-                        "type": "string",
-                        "enum": ["sql_query", "clarify"],
-                    },
-                    "reason": {"type": "string"},
-                    "suggestions": {
-                        "type": "array",
-                        "items": {"type": "string"},
-                    },
-                    #"follow_up": {
-                     #   "type": "array",
-                      #  "items": {"type": "string"},
-                   # },
-                },
-                "required": ["route", "reason", "suggestions"],
-            },
-        },
-    }
-]
-
-# ─────── 4.  Public helper ───────
-def decide_route(question: str, *, history: List[dict] | None = None) -> dict:
-    hints = _fuzzy_suggest(question)
-    detected_lang = langdetect.detect(question)
-
-    msgs = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        *(history or []),
-        {"role": "system", "content": f"Suggestions hint: {json.dumps(hints)}"},
-        {"role": "user", "content": question},
-    ]
-
-    completion = client.chat.completions.create(
-        model=MODEL,
-        messages=msgs,
-        tools=FUNCTION_SPEC,
-        tool_choice="required",
-    )
-
-    choice = completion.choices[0].message
-
-    if choice.tool_calls and choice.tool_calls[0].function.arguments:
-        response = json.loads(choice.tool_calls[0].function.arguments)
-
-        original_suggestions = response.get("suggestions", [])
-        valid_suggestions = [s for s in original_suggestions if s in _FLAT_COLUMNS]
-
-        if len(valid_suggestions) < 3:
-            additional = [s for s in hints if s in _FLAT_COLUMNS and s not in valid_suggestions]
-            valid_suggestions += additional[: 3 - len(valid_suggestions)]
-
-        if response.get("route") == "clarify":
-            valid_suggestions = [] 
-
-        response["suggestions"] = valid_suggestions
-       # response["language"] = detected_lang
-        return response
-
-    return {"error": "Model did not produce a function call"}
-
-def test_schema() -> None:
-    """Переконуємось, що парсер прочитав схему БД без спотворень."""
-    expected_cols: dict[str, set[str]] = {
-        # ─── MERCHANDISING ────────────────────────────────────────────
-        "customers": {"id", "full_name", "email", "city", "created_at"},
-        "products": {"id", "name", "category", "price_cents", "created_at"},
-        "orders": {"id", "customer_id", "total_price_cents", "created_at"},
-        "order_items": {
-            "id", "order_id", "product_id", "quantity", "price_cents", "created_at"
-        },
-
-        # ─── MARKETPLACE ──────────────────────────────────────────────
-        "regions": {"id", "country", "state", "city", "created_at"},
-        "stores": {"id", "name", "region_id", "active", "created_at"},
-        "employees": {
-            "id", "full_name", "store_id", "position", "hire_date", "created_at"
-        },
-
-        # ─── ANALYTICS ────────────────────────────────────────────────
-        "campaigns": {
-            "id", "name", "status", "budget_cents",
-            "start_date", "end_date", "created_at"
-        },
-        "inventory": {"id", "product_id", "store_id", "quantity", "created_at"},
-    }
-
-    # перетворюємо парс-результат у множини для коректного порівняння
-    parsed_cols = {tbl: set(cols) for tbl, cols in _SCHEMA.items()}
-
-    assert parsed_cols == expected_cols, (
-        "❌ Parsed schema does not match expected!\n\n"
-        f"Parsed  : {parsed_cols}\n"
-        f"Expected: {expected_cols}"
-    )
-
-
-
-
-def run_tests():
-    test_cases = [
-        # English
-        "List all products containing peanuts",
-        "How many customers bought chocolate flavor?",
-        "Why are sky blue?",
-        "How calculate average value?",
-
-        # Ukrainian translations (4)
-        "Покажи кампанії з бюджетом більше ніж 50000",
-        "Який продукт є найпопулярнішим цього місяця?",
-        "Скільки замовлень зробив Джон Сміт?",
-        "Покажи користувачів із підтвердженим номером телефону",
-
-        # Polish translations (4)
-        "Pokaż transakcje dla sklepu 'best-store-123'",
-        "Jaki jest wynik NPS sprzedawcy 'John Doe'?",
-        "Pokaż wszystkie kampanie z budżetem powyżej 50 tysięcy",
-        "Dlaczego niebo jest niebieskie?",
-    ]
-
-    total_invalid = 0
-    for idx, question in enumerate(test_cases, 1):
-        print(f"\n{'='*30}\nTest {idx}: {question}\n{'-'*30}")
-        result = decide_route(question)
-        route = result.get("route")
-        reason = result.get("reason")
-        suggestions = result.get("suggestions", [])
-        #follow_up = result.get("follow_up", [])
-        lang = result.get("language", "en")
-
-        print(f"Language    : {lang}")
-        print(f"Route       : {route}")
-        print(f"Reason      : {reason}")
-        print(f"Suggestions : {', '.join(suggestions) or 'None'}")
-       # print(f"Follow-up   : {', '.join(follow_up) or 'None'}")
-
-        invalid = [s for s in suggestions if s not in _FLAT_COLUMNS]
-        if invalid:
-            total_invalid += 1
-            print(f"  Warning: Invalid suggestions detected: {', '.join(invalid)}")
-
-    print(f"\n\u2705 Finished {len(test_cases)} tests. Invalid suggestions found in {total_invalid} cases.")
-
-if __name__ == "__main__":
-    run_tests()
-
-from pprint import pprint
-pprint(_SCHEMA)          # має містити всі таблиці й колонки
-print(len(_FLAT_COLUMNS), "columns total")
-
-# у будь-якому REPL або у кінці скрипта
-from pprint import pprint
-
-pprint(_SCHEMA)          # словник {table: [columns…]}
-print(len(_FLAT_COLUMNS), "columns total")
+from __future__ import annotations
+import asyncio, io, os, time
+from typing import List, Dict
+from openai import OpenAI, AsyncOpenAI  # type: ignore
+
+from router_core import (_FLAT_COLUMNS, _SCHEMA, _prepare, _cache_get,
+                         _cache_put, orjson, prerule_route)
+
+# ─────── configuration ───────
+MODEL = "gpt-4o-mini"
+MAX_SCHEMA_LINES_IN_PROMPT = 120
+SIMILARITY_THRESHOLD = 80
+# Tool-call JSON fits in ~60-100 tokens; latency grows with every
+# generated token, so cap the completion hard.
+MAX_COMPLETION_TOKENS = 120
+API_KEY = os.getenv("OPENAI_API_KEY")
+client = OpenAI(api_key=API_KEY)
+aclient = AsyncOpenAI(api_key=API_KEY)
+
+# ─────── 0.  Response cache key ───────
+# Саме сховище кешу живе в router_core і спільне для всіх варіантів
+def _cache_key(question: str, history: List[dict] | None = None) -> str:
+    # Дата в ключі: промпт розгортає «цей місяць» у конкретні дати,
+    # тож учорашній кеш сьогодні вже невалідний
+    return orjson.dumps(
+        [today, question.strip().lower(),
+         [(m["role"], m["content"]) for m in (history or [])]],
+    ).decode()
+
+
+from datetime import datetime
+today = datetime.today().strftime("%Y-%m-%d")
+
+
+# ─────── 3.  Prompts and function spec ───────
+SYSTEM_PROMPT = f"""
+You are a router for a SQL chat assistant.
+
+You must *always* return a JSON object with the keys:
+  "route"        – "sql_query" or "clarify"
+  "reason"       – short explanation (match user language)
+  "suggestions"  – array of up to 3 table.column strings
+ 
+
+Mandatory Rules
+===============
+• Choose **"sql_query"** when the question can be answered *using any column from the known tables*.  
+  ─ If the query mentions a word that fuzzy-matches ≥ 1 column (hint supplied below), treat it as data-related.  
+  ─ For “top N” / aggregate / date-filtered questions, proceed with SQL generation.
+• Choose **"clarify"** only when **none** of the known columns seem relevant **or** the question is clearly outside business/database context.
+• Never invent table or column names – use only those in the *Known tables* section.
+• If the user gives a vague time period (“this month”, “last year”, “last quarter”), translate it into a concrete date range based on today's date: {today}.
+  For example:
+  – “this month” → from the 1st of the current month to today
+  – “last month” → from the 1st to the last day of the previous month
+  – “last week” → from Monday to Sunday of the previous calendar week
+  – “this year” → from January 1st to today
+  – “last year” → January 1st to December 31st of previous year
+  If the time expression is ambiguous or nonstandard, ask the user for specific dates.
+
+Clarification Guidance
+======================
+• If the query names a **person, product, or store** but lacks an ID/slug, ask for a specific identifier (e.g. customer_id, product_id, store_id).  
+• If the query refers to a **time period** but does not specify concrete dates, ask the user to provide start/end dates.  
+• If multiple interpretations are possible, ask the *most critical* 1-2 follow-up questions to disambiguate.
+• If you choose "clarify", leave "suggestions" empty.
+• The known tables/columns for the current question are supplied in a
+  separate system message as `table(col1,col2,…)` entries.
+
+Contextual Awareness
+====================
+• **customers** → `customers` table (customer-level info)  
+• **orders / order items** → `orders`, `order_items` (sales & quantities)  
+• **products & categories** → `products`  
+• **campaigns & budgets** → `campaigns`  
+• **inventory per store** → `inventory`, joined with `stores`  
+• **regions & stores** → `regions`, `stores`  
+(Use joins across these tables as needed.)
+""".strip()
+
+# Схему виносимо з системного промпту в динамічне повідомлення:
+# інваріантні правила йдуть першими (OpenAI кешує ідентичний префікс),
+# а компактна форма table(col1,col2,…) дає ~40% менше токенів,
+# ніж список table.col
+_SCHEMA_COMPACT = {t: f"{t}({','.join(cols)})" for t, cols in _SCHEMA.items()}
+_SCHEMA_COMPACT_ALL = "; ".join(_SCHEMA_COMPACT.values())
+
+
+def _schema_for_prompt(hints: List[str]) -> str:
+    """Лише таблиці, що перетинаються з fuzzy-підказками (або все, якщо їх нема)."""
+    tables = {h.split(".")[0] for h in hints if "." in h}
+    gated = [c for t, c in _SCHEMA_COMPACT.items() if t in tables]
+    return "; ".join(gated) if gated else _SCHEMA_COMPACT_ALL
+
+
+FUNCTION_SPEC = [
+    {
+        "type": "function",
+        "function": {
+            "name": "decide_action",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "route": {
+                        "type": "string",
+                        "enum": ["sql_query", "clarify"],
+                    },
+                    "reason": {"type": "string"},
+                    "suggestions": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                    },
+                    #"follow_up": {
+                     #   "type": "array",
+                      #  "items": {"type": "string"},
+                   # },
+                },
+                "required": ["route", "reason", "suggestions"],
+            },
+        },
+    }
+]
+
+# ─────── 4.  Public helpers ───────
+def _build_msgs(question: str, hints: List[str],
+                history: List[dict] | None = None) -> List[dict]:
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *(history or []),
+        {"role": "system", "content": (
+            f"Known tables: {_schema_for_prompt(hints)}\n"
+            f"Suggestions hint: {orjson.dumps(hints).decode()}"
+        )},
+        {"role": "user", "content": question},
+    ]
+
+
+def _postprocess(response: dict, hints: List[str]) -> dict:
+    original_suggestions = response.get("suggestions", [])
+    valid_suggestions = [s for s in original_suggestions if s in _FLAT_COLUMNS]
+
+    if len(valid_suggestions) < 3:
+        additional = [s for s in hints if s in _FLAT_COLUMNS and s not in valid_suggestions]
+        valid_suggestions += additional[: 3 - len(valid_suggestions)]
+
+    if response.get("route") == "clarify":
+        valid_suggestions = []
+
+    response["suggestions"] = valid_suggestions
+    return response
+
+
+# Локальний пре-роутер: очевидні питання вирішуємо без жодного запиту до
+# API — субмілісекундна відповідь замість сотень мс мережі.
+_LOCAL_REASONS = {
+    "sql_query": {
+        "en": "The question maps directly onto known columns.",
+        "uk": "Питання напряму збігається з відомими колонками.",
+        "pl": "Pytanie pasuje bezpośrednio do znanych kolumn.",
+    },
+    "clarify": {
+        "en": "No known column matches this request; a table or attribute is needed.",
+        "uk": "Жодна відома колонка не відповідає запиту — уточніть таблицю чи атрибут.",
+        "pl": "Żadna znana kolumna nie pasuje do zapytania — wskaż tabelę lub atrybut.",
+    },
+}
+
+
+def _local_decision(route: str, hints: List[str], lang: str) -> dict:
+    reasons = _LOCAL_REASONS[route]
+    return {
+        "route": route,
+        "reason": reasons.get(lang, reasons["en"]),
+        "suggestions": list(hints),
+    }
+
+
+def decide_route(question: str, *, history: List[dict] | None = None) -> dict:
+    cache_key = _cache_key(question, history)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
+    _tokens, hints, detected_lang = _prepare(question)
+
+    # Пре-роутер спрацьовує лише без history: контекст діалогу може
+    # змінити рішення, тож неоднозначні випадки лишаємо LLM
+    if not history:
+        pre = prerule_route(question)
+        if pre is not None:
+            response = _postprocess(_local_decision(pre, hints, detected_lang), hints)
+            _cache_put(cache_key, response)
+            return response
+
+    # NEW: стрімимо відповідь — перший байт приходить одразу, а не після
+    # повної генерації; аргументи tool-call накопичуємо по шматках
+    stream = client.chat.completions.create(
+        model=MODEL,
+        messages=_build_msgs(question, hints, history),
+        tools=FUNCTION_SPEC,
+        tool_choice="required",
+        max_tokens=MAX_COMPLETION_TOKENS,
+        temperature=0,
+        stream=True,
+    )
+
+    buf = io.StringIO()
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta and delta.tool_calls:
+            fragment = delta.tool_calls[0].function.arguments
+            if fragment:
+                buf.write(fragment)
+
+    raw_args = buf.getvalue()
+    if raw_args:
+        try:
+            args = orjson.loads(raw_args)
+        except ValueError:
+            # max_tokens міг обрізати JSON посеред генерації
+            return {"error": "Function-call arguments were truncated or malformed"}
+        response = _postprocess(args, hints)
+       # response["language"] = detected_lang
+        _cache_put(cache_key, response)
+        return response
+
+    return {"error": "Model did not produce a function call"}
+
+
+# NEW: коалесінг дублікатів «у польоті» — N одночасних викликів з тим самим
+# питанням платять за 1 запит до API, решта чекає на спільний Future
+_inflight: dict[str, asyncio.Future] = {}
+_inflight_lock = asyncio.Lock()
+
+
+async def _arequest(question: str, hints: List[str],
+                    history: List[dict] | None = None) -> dict:
+    stream = await aclient.chat.completions.create(
+        model=MODEL,
+        messages=_build_msgs(question, hints, history),
+        tools=FUNCTION_SPEC,
+        tool_choice="required",
+        max_tokens=MAX_COMPLETION_TOKENS,
+        temperature=0,
+        stream=True,
+    )
+
+    buf = io.StringIO()
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta and delta.tool_calls:
+            fragment = delta.tool_calls[0].function.arguments
+            if fragment:
+                buf.write(fragment)
+
+    raw_args = buf.getvalue()
+    if raw_args:
+        try:
+            args = orjson.loads(raw_args)
+        except ValueError:
+            return {"error": "Function-call arguments were truncated or malformed"}
+        return _postprocess(args, hints)
+    return {"error": "Model did not produce a function call"}
+
+
+async def adecide_route(question: str, *, history: List[dict] | None = None) -> dict:
+    """Асинхронний двійник decide_route — для паралельних прогонів."""
+    cache_key = _cache_key(question, history)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
+    if not history:
+        pre = prerule_route(question)
+        if pre is not None:
+            _tokens, hints, lang = _prepare(question)
+            response = _postprocess(_local_decision(pre, hints, lang), hints)
+            _cache_put(cache_key, response)
+            return response
+
+    async with _inflight_lock:
+        pending = _inflight.get(cache_key)
+        if pending is None:
+            pending = asyncio.get_running_loop().create_future()
+            _inflight[cache_key] = pending
+            owner = True
+        else:
+            owner = False
+
+    if not owner:
+        return dict(await pending)
+
+    try:
+        response = await _arequest(question, _prepare(question)[1], history)
+        if "error" not in response:
+            _cache_put(cache_key, response)
+        pending.set_result(response)
+        return response
+    except BaseException as exc:
+        pending.set_exception(exc)
+        raise
+    finally:
+        async with _inflight_lock:
+            _inflight.pop(cache_key, None)
+
+def test_schema() -> None:
+    """Переконуємось, що парсер прочитав схему БД без спотворень."""
+    expected_cols: dict[str, set[str]] = {
+        # ─── MERCHANDISING ────────────────────────────────────────────
+        "customers": {"id", "full_name", "email", "city", "created_at"},
+        "products": {"id", "name", "category", "price_cents", "created_at"},
+        "orders": {"id", "customer_id", "total_price_cents", "created_at"},
+        "order_items": {
+            "id", "order_id", "product_id", "quantity", "price_cents", "created_at"
+        },
+
+        # ─── MARKETPLACE ──────────────────────────────────────────────
+        "regions": {"id", "country", "state", "city", "created_at"},
+        "stores": {"id", "name", "region_id", "active", "created_at"},
+        "employees": {
+            "id", "full_name", "store_id", "position", "hire_date", "created_at"
+        },
+
+        # ─── ANALYTICS ────────────────────────────────────────────────
+        "campaigns": {
+            "id", "name", "status", "budget_cents",
+            "start_date", "end_date", "created_at"
+        },
+        "inventory": {"id", "product_id", "store_id", "quantity", "created_at"},
+    }
+
+    # перетворюємо парс-результат у множини для коректного порівняння
+    parsed_cols = {tbl: set(cols) for tbl, cols in _SCHEMA.items()}
+
+    assert parsed_cols == expected_cols, (
+        "❌ Parsed schema does not match expected!\n\n"
+        f"Parsed  : {parsed_cols}\n"
+        f"Expected: {expected_cols}"
+    )
+
+
+
+
+TEST_CASES = [
+    # English
+    "List all products containing peanuts",
+    "How many customers bought chocolate flavor?",
+    "Why are sky blue?",
+    "How calculate average value?",
+
+    # Ukrainian translations (4)
+    "Покажи кампанії з бюджетом більше ніж 50000",
+    "Який продукт є найпопулярнішим цього місяця?",
+    "Скільки замовлень зробив Джон Сміт?",
+    "Покажи користувачів із підтвердженим номером телефону",
+
+    # Polish translations (4)
+    "Pokaż transakcje dla sklepu 'best-store-123'",
+    "Jaki jest wynik NPS sprzedawcy 'John Doe'?",
+    "Pokaż wszystkie kampanie z budżetem powyżej 50 tysięcy",
+    "Dlaczego niebo jest niebieskie?",
+]
+
+
+def _chat_body(question: str) -> dict:
+    """Тіло /v1/chat/completions для одного питання (як у decide_route)."""
+    hints = _prepare(question)[1]
+    return {
+        "model": MODEL,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "system", "content": (
+                f"Known tables: {_schema_for_prompt(hints)}\n"
+                f"Suggestions hint: {orjson.dumps(hints).decode()}"
+            )},
+            {"role": "user", "content": question},
+        ],
+        "tools": FUNCTION_SPEC,
+        "tool_choice": "required",
+        "max_tokens": MAX_COMPLETION_TOKENS,
+        "temperature": 0,
+    }
+
+
+def run_tests_batch(poll_seconds: int = 10) -> None:
+    """Прогін тестів через OpenAI Batch API.
+
+    Тести не потребують живої взаємодії, тож batch дає -50% ціни і
+    паралельне виконання на боці сервера замість 12 послідовних викликів.
+    """
+    lines = [
+        orjson.dumps(
+            {
+                "custom_id": f"test-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": _chat_body(q),
+            },
+        ).decode()
+        for i, q in enumerate(TEST_CASES, 1)
+    ]
+    batch_file = client.files.create(
+        file=("router_tests.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_seconds)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        print(f"❌ Batch finished with status={batch.status}")
+        return
+
+    results: dict[str, dict] = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        item = orjson.loads(line)
+        message = item["response"]["body"]["choices"][0]["message"]
+        args = message["tool_calls"][0]["function"]["arguments"]
+        results[item["custom_id"]] = orjson.loads(args)
+
+    total_invalid = 0
+    for i, question in enumerate(TEST_CASES, 1):
+        r = results.get(f"test-{i}", {})
+        suggestions = r.get("suggestions", [])
+        print(f"\n{'='*30}\nTest {i}: {question}\n{'-'*30}")
+        print(f"Route       : {r.get('route')}")
+        print(f"Reason      : {r.get('reason')}")
+        print(f"Suggestions : {', '.join(suggestions) or 'None'}")
+
+        invalid = [s for s in suggestions if s not in _FLAT_COLUMNS]
+        if invalid:
+            total_invalid += 1
+            print(f"  Warning: Invalid suggestions detected: {', '.join(invalid)}")
+
+    print(f"\n✅ Finished {len(TEST_CASES)} tests. Invalid suggestions found in {total_invalid} cases.")
+
+
+def run_tests():
+    # Запити незалежні — ганяємо їх паралельно: сумарний час ≈ max(latency)
+    # замість суми всіх раундтрипів
+    async def _gather() -> list[dict]:
+        sem = asyncio.Semaphore(8)
+
+        async def _one(q: str) -> dict:
+            async with sem:
+                return await adecide_route(q)
+
+        return await asyncio.gather(*[_one(q) for q in TEST_CASES])
+
+    results = asyncio.run(_gather())
+
+    total_invalid = 0
+    for idx, (question, result) in enumerate(zip(TEST_CASES, results), 1):
+        print(f"\n{'='*30}\nTest {idx}: {question}\n{'-'*30}")
+        route = result.get("route")
+        reason = result.get("reason")
+        suggestions = result.get("suggestions", [])
+        #follow_up = result.get("follow_up", [])
+        lang = result.get("language", "en")
+
+        print(f"Language    : {lang}")
+        print(f"Route       : {route}")
+        print(f"Reason      : {reason}")
+        print(f"Suggestions : {', '.join(suggestions) or 'None'}")
+       # print(f"Follow-up   : {', '.join(follow_up) or 'None'}")
+
+        invalid = [s for s in suggestions if s not in _FLAT_COLUMNS]
+        if invalid:
+            total_invalid += 1
+            print(f"  Warning: Invalid suggestions detected: {', '.join(invalid)}")
+
+    print(f"\n\u2705 Finished {len(TEST_CASES)} tests. Invalid suggestions found in {total_invalid} cases.")
+
+if __name__ == "__main__":
+    # ROUTER_BATCH_TESTS=1 \u2192 \u0434\u0435\u0448\u0435\u0432\u0448\u0438\u0439 (\u221250%) \u043f\u0430\u0440\u0430\u043b\u0435\u043b\u044c\u043d\u0438\u0439 \u043f\u0440\u043e\u0433\u0456\u043d \u0447\u0435\u0440\u0435\u0437 Batch API
+    if os.getenv("ROUTER_BATCH_TESTS"):
+        run_tests_batch()
+    else:
+        run_tests()
+
+from pprint import pprint
+pprint(_SCHEMA)          # має містити всі таблиці й колонки
+print(len(_FLAT_COLUMNS), "columns total")
+
+# у будь-якому REPL або у кінці скрипта
+from pprint import pprint
+
+pprint(_SCHEMA)          # словник {table: [columns…]}
+print(len(_FLAT_COLUMNS), "columns total")
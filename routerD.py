@@ -5,77 +5,31 @@ which opens in any browser and shows user/assistant bubbles.
 """
 from __future__ import annotations
 
-import json
 import os
 import pathlib
-import re
 from datetime import datetime
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict, List, Tuple
 
-from langdetect import detect
 from langchain_openai import ChatOpenAI
-from rapidfuzz import fuzz, process
+
+from router_core import (_prepare, _cache_get, _cache_put, orjson,
+                         prerule_route, _decode_args, _local_decision,
+                         _known_for_prompt, _PROMPT_TAIL, _HTTP_CLIENT)
 
 # ───────────── CONFIG ─────────────
 MODEL = "gpt-4o-mini"
-DB_DESC_FILE = pathlib.Path("instructions/db_description.txt")
-MAX_SCHEMA_LINES_IN_PROMPT = 120
 API_KEY = os.getenv("OPENAI_API_KEY")
 
 today = datetime.today().strftime("%Y-%m-%d")
 
-# ───────── db_description.txt → schema ─────────
-
-def _parse_db_description(path: pathlib.Path) -> Dict[str, List[str]]:
-    """Parse markdown-style schema description into {table: [columns…]}."""
-    schema: Dict[str, List[str]] = {}
-    current: str | None = None
-
-    for line in path.read_text(encoding="utf-8").splitlines():
-        tbl = re.match(r"^###\s+([A-Za-z0-9_]+)", line)
-        if tbl:
-            current = tbl.group(1).lower()
-            schema[current] = []
-            continue
-
-        if current:
-            col = re.match(r"^[ \t\-]*([A-Za-z0-9_]+):", line)
-            if col:
-                schema[current].append(col.group(1).lower())
-
-    return schema
-
-
-_SCHEMA = _parse_db_description(DB_DESC_FILE)
-_FLAT_COLUMNS = [f"{t}.{c}" for t, cols in _SCHEMA.items() for c in cols]
-
-# ───────── Local fuzzy suggestions ─────────
-
-def fuzzy_suggest(text: str, k: int = 3) -> List[str]:
-    """Return up to *k* column names similar to tokens in *text*."""
-    tokens = re.findall(r"[A-Za-z0-9_]{3,}", text.lower())
-    best: dict[str, int] = {}
-
-    for tok in tokens:
-        for cand, score, _ in process.extract(
-            tok, _FLAT_COLUMNS, scorer=fuzz.partial_ratio, limit=20
-        ):
-            if score >= 65:
-                best[cand] = max(best.get(cand, 0), score)
-
-    return sorted(best, key=best.get, reverse=True)[:k]
-
 # ───────── Prompt builder ─────────
 
-def build_system_prompt(hints: List[str], lang: str) -> str:
-    """
-    Build SYSTEM prompt enforcing one‑paragraph `message` and proper routing.
-    (Kept identical to previous canvas version.)
-    """
-    known = '; '.join(_FLAT_COLUMNS[:MAX_SCHEMA_LINES_IN_PROMPT])
-    hints_json = json.dumps(hints)
-
-    return f"""
+# The invariant rules prefix is frozen once at import; per call only the
+# dynamic tail from router_core is appended. An identical long prefix
+# also lets the provider's automatic prompt-prefix cache reuse the
+# server-side KV state.
+_PROMPT_PREFIX = f"""
 You are a router for a SQL chat assistant. Respond with **only** valid JSON:
 {{"route": "sql_query" | "clarify", "message": "<string>"}}
 
@@ -83,19 +37,31 @@ RULES FOR `message` (one paragraph):
 • 1–3 sentences, single paragraph.
 • If the user asks to list/show/count/find/average/filter data *and* all requested attributes exist, set route = "sql_query".
 • If the request references attributes not present in the schema (e.g. “gluten‑free”, “discount codes”, “costs”, “performance reviews”), set route = "clarify".
-• sql_query → mention **at least two fully‑qualified columns** if any: {hints_json or '[]'}; no square brackets. If the result depends on a time period, ask a brief follow‑up question for the desired date range.
+• sql_query → mention **at least two fully‑qualified columns** from the hints below if any; no square brackets. If the result depends on a time period, ask a brief follow‑up question for the desired date range.
 • clarify  → include at least one question; also use when performance/effectiveness is asked without metrics.
-• **Write the message in the same language as the user** (detected = {lang}).
+• **Write the message in the same language as the user** (detected language is given below).
 • No repeats of user wording.
 
 If you break the format, the response will be rejected.
 
 Context (do NOT mention verbatim):
   • today = {today}
-  • known columns (truncated): {known}
 """.strip()
 
 
+@lru_cache(maxsize=1024)
+def build_system_prompt(hints: Tuple[str, ...], lang: str) -> str:
+    """
+    Build SYSTEM prompt enforcing one‑paragraph `message` and proper routing.
+    (Rules identical to previous canvas version; only hints/lang vary per call.)
+    """
+    return _PROMPT_PREFIX + _PROMPT_TAIL.format(
+        known=_known_for_prompt(hints),
+        hints_json=orjson.dumps(hints).decode() or "[]",
+        lang=lang,
+    )
+
+
 # ───────── OpenAI function schema ─────────
 function_schema = {
     "name": "route_decision",
@@ -111,14 +77,42 @@ function_schema = {
 }
 
 # Low temperature but not zero (allows a little creativity)
-llm = ChatOpenAI(model=MODEL, api_key=API_KEY, temperature=0.05).bind_tools([function_schema])
+# With OPENROUTER_API_KEY set, calls go through OpenRouter, which picks
+# the backing provider with the best throughput per request — same model,
+# noticeably better tail latency. Default stays plain OpenAI.
+OPENROUTER_KEY = os.getenv("OPENROUTER_API_KEY")
+if OPENROUTER_KEY:
+    llm = ChatOpenAI(
+        model=MODEL,
+        api_key=OPENROUTER_KEY,
+        base_url="https://openrouter.ai/api/v1",
+        temperature=0.05,
+        model_kwargs={"provider": {"sort": "throughput"}},
+        http_client=_HTTP_CLIENT,
+    ).bind_tools([function_schema])
+else:
+    llm = ChatOpenAI(model=MODEL, api_key=API_KEY, temperature=0.05,
+                     http_client=_HTTP_CLIENT).bind_tools([function_schema])
 
 # ───────── Main helper ─────────
 
 def decide_route(question: str) -> dict:
     """Return routing decision JSON for a single *question*."""
-    hints = fuzzy_suggest(question)
-    lang = detect(question)
+    cache_key = f"D:{today}:" + question.strip().lower()
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
+    _tokens, hints, lang = _prepare(question)
+
+    # Clear-cut questions are answered locally — no LLM round-trip
+    # (clarify when nothing matches; sql_query too with ROUTER_LOCAL_SQL=1).
+    pre = prerule_route(question)
+    if pre is not None:
+        data = _local_decision(pre, hints, lang)
+        data["language"] = lang
+        _cache_put(cache_key, data)
+        return data
 
     messages = [
         {"role": "system", "content": build_system_prompt(hints, lang)},
@@ -133,11 +127,12 @@ def decide_route(question: str) -> dict:
     if isinstance(tc, dict):
         data = tc.get("args") or tc.get("arguments")
         if not data and "function" in tc:
-            data = json.loads(tc["function"]["arguments"])
+            data = _decode_args(tc["function"]["arguments"])
     else:
         data = tc.args
 
     data["language"] = lang
+    _cache_put(cache_key, data)
     return data
 
 # ───────── Pretty HTML output ─────────
@@ -0,0 +1,501 @@
+"""Core shared by the three router variants.
+
+router.py, routerD.py and routerL.py each re-parsed
+`instructions/db_description.txt`, rebuilt the fuzzy index, reran
+language detection and kept their own response cache. Everything that
+does not depend on the variant-specific prompt/LLM client lives here:
+schema parsing, `_prepare(question)` (tokens + hints + language, behind
+one lru_cache) and the exact-match response cache — so a driver
+importing more than one router pays for the work once and the caches
+are shared across entry points.
+"""
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import pathlib
+import pickle
+import re
+import shelve
+import string
+import sys
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import httpx
+import numpy as np
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+
+# orjson serializes/parses in C, 3-10x faster than stdlib json; the shim
+# keeps orjson's bytes-oriented surface on stdlib json so call sites in
+# the router variants never branch on availability.
+try:
+    import orjson
+except ImportError:
+    class orjson:  # type: ignore
+        loads = staticmethod(json.loads)
+
+        @staticmethod
+        def dumps(obj) -> bytes:
+            return json.dumps(obj, ensure_ascii=False).encode()
+
+# ───────────── CONFIG ─────────────
+DB_DESC_FILE = pathlib.Path("instructions/db_description.txt")
+FASTTEXT_MODEL_FILE = "lid.176.ftz"
+
+# ───────── Response cache (exact match) ─────────
+# Identical questions short-circuit before the HTTP request: a dict hit
+# costs microseconds vs hundreds of ms of network + token cost. Keys are
+# namespaced per variant AND carry the prompt date — the prompts resolve
+# "this month"/"last year" into concrete ranges, so a decision persisted
+# today must not be replayed verbatim next month.
+ROUTE_CACHE_FILE = ".router_cache"
+ROUTE_CACHE_MAX = 4096
+_route_cache: dict[str, dict] = {}
+
+# One shelve handle per process instead of an open/close pair on every
+# miss and every write; False marks persistence as unavailable.
+_SHELF = None
+
+
+def _shelf() -> shelve.Shelf | None:
+    global _SHELF
+    if _SHELF is None:
+        try:
+            _SHELF = shelve.open(ROUTE_CACHE_FILE)
+            atexit.register(_SHELF.close)
+        except Exception:
+            _SHELF = False
+    return _SHELF or None
+
+
+def _cache_get(key: str) -> dict | None:
+    if key in _route_cache:
+        return _route_cache[key]
+    db = _shelf()  # warm start across restarts
+    try:
+        if db is not None and key in db:
+            _route_cache[key] = db[key]
+            return _route_cache[key]
+    except Exception:
+        pass
+    return None
+
+
+def _cache_put(key: str, value: dict) -> None:
+    while len(_route_cache) >= ROUTE_CACHE_MAX:
+        _route_cache.pop(next(iter(_route_cache)))
+    _route_cache[key] = value
+    db = _shelf()
+    try:
+        if db is not None:
+            db[key] = value
+    except Exception:
+        pass
+
+# ───────── Language detection ─────────
+# fasttext lid.176 classifies a short string in microseconds via compiled
+# n-gram lookups; pure-Python langdetect stays as a fallback for
+# deployments without the model file.
+try:
+    import fasttext  # type: ignore
+    _LID = fasttext.load_model(FASTTEXT_MODEL_FILE)
+except Exception:
+    _LID = None
+
+
+# langdetect.detect() reloads all 55 profiles from disk per call; keep a
+# single factory per process and only create the lightweight Detector.
+# Only common languages are loaded: the full 55 profiles hold ~76 MB of
+# n-gram arrays that router traffic (en/uk/pl + neighbours) never touches.
+_LD_LANGS = {
+    "en", "uk", "pl", "ru", "de", "es", "fr", "it", "pt",
+    "ja", "ko", "zh-cn", "zh-tw", "ar", "hi",
+}
+_LD_FACTORY = None
+
+
+def _langdetect_singleton(text: str) -> str:
+    global _LD_FACTORY
+    if _LD_FACTORY is None:
+        from langdetect.detector_factory import DetectorFactory, PROFILES_DIRECTORY
+        from langdetect.utils.lang_profile import LangProfile
+        _LD_FACTORY = DetectorFactory()
+        wanted = [f for f in sorted(os.listdir(PROFILES_DIRECTORY)) if f in _LD_LANGS]
+        for index, name in enumerate(wanted):
+            with open(os.path.join(PROFILES_DIRECTORY, name), encoding="utf-8") as fh:
+                profile = LangProfile(**json.load(fh))
+            _LD_FACTORY.add_profile(profile, index, len(wanted))
+    detector = _LD_FACTORY.create()
+    detector.append(text)
+    return detector.detect()
+
+
+# Script-range fast path: questions whose alphabet is unambiguous skip
+# the models (Cyrillic with uk-specific letters → uk, Polish diacritics
+# → pl). ASCII is deliberately NOT decided here: diacritic-free Polish
+# ("Dlaczego niebo jest niebieskie?") is pure ASCII too, and fasttext
+# classifies it correctly in microseconds anyway.
+_UK_CHARS = set("іїєґ")
+_PL_CHARS = set("ąćęłńóśźż")
+
+
+def _quick_lang(s: str) -> str | None:
+    low = s.lower()
+    if any("\u0400" <= c <= "\u04FF" for c in low):
+        return "uk" if any(c in _UK_CHARS for c in low) else "ru"
+    if any(c in _PL_CHARS for c in low):
+        return "pl"
+    return None
+
+
+@lru_cache(maxsize=4096)
+def detect(text: str) -> str:
+    """Detect the language code of *text* (fast script scan, then fasttext,
+    then langdetect)."""
+    quick = _quick_lang(text)
+    if quick is not None:
+        return quick
+    if _LID is not None:
+        label = _LID.predict(text.replace("\n", " "), k=1)[0][0]
+        return label.removeprefix("__label__")
+    # Only when the slow langdetect path is all that's left does the
+    # ASCII → en guess pay off; mislabeling diacritic-free pl/de there is
+    # the accepted trade for skipping it on the bulk of traffic.
+    if text.isascii():
+        return "en"
+    return _langdetect_singleton(text)
+
+# ───────── db_description.txt → schema ─────────
+
+# Single alternation in MULTILINE mode: one finditer pass over the whole
+# file instead of a Python-level loop with a match call per line.
+_LINE_RE = re.compile(r"^###\s+([A-Za-z0-9_]+)|^[ \t\-]*([A-Za-z0-9_]+):", re.MULTILINE)
+
+# Parsed schema is memoized to a pickle keyed on (mtime, size), so warm
+# process starts skip the regex pass entirely.
+_SCHEMA_PICKLE = pathlib.Path.home() / ".cache" / "router" / "schema.pkl"
+
+
+def _parse_db_description(path: pathlib.Path) -> Dict[str, List[str]]:
+    """Parse markdown-style schema description into {table: [columns…]}."""
+    schema: Dict[str, List[str]] = {}
+    current: str | None = None
+
+    for m in _LINE_RE.finditer(path.read_text(encoding="utf-8")):
+        tbl, col = m.groups()
+        if tbl:
+            current = tbl.lower()
+            schema[current] = []
+        elif current and col:
+            schema[current].append(col.lower())
+
+    return schema
+
+
+def _load_schema(path: pathlib.Path) -> Dict[str, List[str]]:
+    st = path.stat()
+    key = (st.st_mtime_ns, st.st_size)
+    try:
+        with open(_SCHEMA_PICKLE, "rb") as fh:
+            cached_key, schema = pickle.load(fh)
+        if cached_key == key:
+            return schema
+    except Exception:
+        pass
+    schema = _parse_db_description(path)
+    try:
+        _SCHEMA_PICKLE.parent.mkdir(parents=True, exist_ok=True)
+        with open(_SCHEMA_PICKLE, "wb") as fh:
+            pickle.dump((key, schema), fh, pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        pass
+    return schema
+
+
+_SCHEMA = _load_schema(DB_DESC_FILE)
+# Interned once: every hint tuple, cache entry and prompt join then
+# shares the same string objects instead of allocating copies.
+_FLAT_COLUMNS = [sys.intern(f"{t}.{c}") for t, cols in _SCHEMA.items() for c in cols]
+
+# ───────── Local fuzzy suggestions ─────────
+
+# translate+split run entirely in C — no regex engine start-up per short
+# question; '_' is kept inside tokens (price_cents etc.).
+_PUNCT_TO_SPACE = str.maketrans({c: " " for c in string.punctuation if c != "_"})
+
+
+@lru_cache(maxsize=4096)
+def _tokenize(text: str) -> Tuple[str, ...]:
+    return tuple(
+        t for t in dict.fromkeys(text.lower().translate(_PUNCT_TO_SPACE).split())
+        if len(t) >= 3 and t.isascii()
+    )
+
+
+# Trigram inverted index: score only columns sharing at least one
+# trigram with the question tokens (K ≪ N); an empty intersection falls
+# back to an honest full scan.
+def _trigrams(s: str) -> set:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+_TRIGRAM_INDEX: dict[str, set[int]] = {}
+for _i, _c in enumerate(_FLAT_COLUMNS):
+    for _g in _trigrams(_c):
+        _TRIGRAM_INDEX.setdefault(_g, set()).add(_i)
+
+
+def _candidate_ids(tokens: Tuple[str, ...]) -> List[int]:
+    ids: set[int] = set()
+    for tok in tokens:
+        for g in _trigrams(tok):
+            ids.update(_TRIGRAM_INDEX.get(g, ()))
+    return sorted(ids) if ids else list(range(len(_FLAT_COLUMNS)))
+
+
+# Candidates are normalized once at import ('.'/'_' → space via
+# default_process); with processor=None rapidfuzz skips the per-call
+# UTF-8 → buffer conversion and normalization of every candidate.
+_FLAT_COLUMNS_PP = [default_process(c) for c in _FLAT_COLUMNS]
+
+
+# score_cutoff is applied inside rapidfuzz's C inner loop (SIMD early
+# exit); pairs below it come back as 0 and never reach Python.
+SCORE_CUTOFF = 65
+
+# Literal containment beats fuzzy scoring: when the question already
+# names a column ("orders", "price_cents"), map it directly and skip
+# cdist. pyahocorasick flags every pattern in one pass over the raw
+# text; the fallback checks tokens against a bare-name dict. Names
+# shorter than 4 chars ("id") are substring traps and stay token-only.
+_BARE_NAMES: dict[str, List[str]] = {}
+for _qualified in _FLAT_COLUMNS:
+    _tbl, _col = _qualified.split(".", 1)
+    _BARE_NAMES.setdefault(_col, []).append(_qualified)
+    _BARE_NAMES.setdefault(_tbl, []).append(_qualified)
+
+try:
+    import ahocorasick  # type: ignore
+
+    _AUTOMATON = ahocorasick.Automaton()
+    for _name, _cols in _BARE_NAMES.items():
+        if len(_name) >= 4:
+            _AUTOMATON.add_word(_name, _cols)
+    _AUTOMATON.make_automaton()
+
+    def _literal_hits(text: str, tokens: Tuple[str, ...]) -> List[str]:
+        hits: List[str] = []
+        for _end, cols in _AUTOMATON.iter(text.lower()):
+            for col in cols:
+                if col not in hits:
+                    hits.append(col)
+        return hits
+except ImportError:
+    def _literal_hits(text: str, tokens: Tuple[str, ...]) -> List[str]:
+        hits: List[str] = []
+        for tok in tokens:
+            for col in _BARE_NAMES.get(tok, ()):
+                if col not in hits:
+                    hits.append(col)
+        return hits
+
+# Optional: a JIT'd single pass over the uint8 score matrix for the
+# column-wise max. cache=True persists the compiled kernel, so only the
+# very first process pays the compile cost; numpy is the fallback.
+try:
+    from numba import njit  # type: ignore
+
+    @njit(cache=True)
+    def _best_scores(scores):
+        n_rows, n_cols = scores.shape
+        best = np.zeros(n_cols, np.uint8)
+        for i in range(n_rows):
+            for j in range(n_cols):
+                v = scores[i, j]
+                if v > best[j]:
+                    best[j] = v
+        return best
+except ImportError:
+    def _best_scores(scores):
+        return scores.max(axis=0)
+
+
+@lru_cache(maxsize=4096)
+def _suggest_scored(text: str, k: int = 3) -> Tuple[Tuple[str, int], ...]:
+    """Up to *k* (column, score) pairs for tokens in *text*, best first."""
+    tokens = _tokenize(text)
+    # No token of length < 4 can clear the 65 cutoff against real column
+    # names — skip the whole scan for token-poor questions.
+    if not tokens or max(map(len, tokens)) < 4:
+        return ()
+
+    literal = _literal_hits(text, tokens)
+    if len(literal) >= k:
+        return tuple((col, 100) for col in literal[:k])
+
+    ids = _candidate_ids(tokens)
+    # Full-scan fallback reuses the precomputed candidate list instead of
+    # rebuilding it element by element.
+    if len(ids) == len(_FLAT_COLUMNS):
+        cands = _FLAT_COLUMNS_PP
+    else:
+        cands = [_FLAT_COLUMNS_PP[i] for i in ids]
+
+    # One vectorized cdist call instead of a per-token extract loop:
+    # every (token, column) pair is scored in C in a single pass.
+    scores = process.cdist(
+        tokens,
+        cands,
+        scorer=fuzz.partial_ratio,
+        processor=None,
+        score_cutoff=SCORE_CUTOFF,
+        dtype=np.uint8,
+        workers=-1,
+    )
+    best = _best_scores(scores)
+    # argpartition finds the k winners in O(n); only those k get sorted,
+    # instead of argsort ordering the whole candidate axis.
+    k_eff = min(k, best.size)
+    top = np.argpartition(best, -k_eff)[-k_eff:]
+    top = top[np.argsort(best[top])[::-1]]
+    return tuple((_FLAT_COLUMNS[ids[i]], int(best[i])) for i in top if best[i])
+
+
+def fuzzy_suggest(text: str, k: int = 3) -> Tuple[str, ...]:
+    """Return up to *k* column names similar to tokens in *text*."""
+    return tuple(name for name, _score in _suggest_scored(text, k))
+
+# ───────── Rule-based pre-router ─────────
+
+# Questions with no schema hit and no action verb never need the LLM —
+# they are clarify by construction. Only that side short-circuits by
+# default: a strong hit plus a verb is NOT enough for sql_query (a
+# table mention scores 100 even when the asked-for attribute does not
+# exist, e.g. "orders that used discount codes"), so the sql side is
+# opt-in via ROUTER_LOCAL_SQL=1.
+_ACTION_VERBS = {
+    # en
+    "list", "show", "count", "find", "average", "filter", "display",
+    "which", "how", "many", "total",
+    # uk
+    "скільки", "покажи", "перелічи", "знайди", "виведи", "який", "яка", "які",
+    # pl
+    "pokaż", "ile", "wyświetl", "znajdź", "policz", "jaki", "jaka", "które",
+}
+
+# Score thresholds for the local decision (partial_ratio, 0-100).
+PRE_SQL_CUTOFF = 85
+PRE_CLARIFY_CUTOFF = 50
+
+_LOCAL_SQL = os.getenv("ROUTER_LOCAL_SQL") == "1"
+
+
+def prerule_route(question: str) -> str | None:
+    """Local routing verdict: "sql_query"/"clarify" when the question is
+    clear-cut, None when the LLM should decide."""
+    # Explicit k: lru_cache keys (q,) and (q, 3) separately, and _prepare
+    # already populated (q, 3) via fuzzy_suggest — reuse that entry
+    # instead of running the cdist scan a second time.
+    scored = _suggest_scored(question, 3)
+    top = scored[0][1] if scored else 0
+    words = set(question.lower().translate(_PUNCT_TO_SPACE).split())
+    has_verb = not words.isdisjoint(_ACTION_VERBS)
+    if _LOCAL_SQL and top >= PRE_SQL_CUTOFF and has_verb:
+        return "sql_query"
+    if top < PRE_CLARIFY_CUTOFF and not has_verb:
+        return "clarify"
+    return None
+
+# ───────── Shared routerD/routerL helpers ─────────
+# The two langchain variants differ only in temperature and demo harness;
+# the prompt-tail machinery, local-decision messages, argument decoding
+# and the HTTP pool they both carried are deduplicated here.
+
+MAX_SCHEMA_LINES_IN_PROMPT = 120
+_KNOWN_COLUMNS_STR = "; ".join(_FLAT_COLUMNS[:MAX_SCHEMA_LINES_IN_PROMPT])
+
+
+def _known_for_prompt(hints: Tuple[str, ...]) -> str:
+    """Only columns from tables the fuzzy hints point at — the known-columns
+    block shrinks 5-20x; with no hints, fall back to the truncated global
+    list so the model still sees the schema."""
+    tables = {h.split(".")[0] for h in hints if "." in h}
+    gated = [c for c in _FLAT_COLUMNS if c.split(".")[0] in tables]
+    return "; ".join(gated) if gated else _KNOWN_COLUMNS_STR
+
+
+# The dynamic prompt lines live in one template; per call a single
+# .format splices the three values and one concatenation appends them to
+# the variant's frozen prefix (which holds literal JSON braces, so it
+# stays outside the .format template).
+_PROMPT_TAIL = (
+    "\nKnown columns: {known}"
+    "\nColumn hints: {hints_json}"
+    "\nDetected language: {lang}"
+)
+
+# Rule-based pre-router messages: when prerule_route decides locally, the
+# user-facing paragraph is templated here instead of generated by the LLM.
+_LOCAL_MSGS = {
+    "sql_query": {
+        "en": "I'll query the database using columns {cols}. What date range should I use?",
+        "uk": "Сформую SQL-запит за колонками {cols}. За який період потрібні дані?",
+        "pl": "Przygotuję zapytanie SQL na kolumnach {cols}. Jaki zakres dat mam przyjąć?",
+    },
+    "clarify": {
+        "en": "I can't map this request to a known column. Could you point to a specific table or attribute?",
+        "uk": "Не можу зіставити запит із жодною відомою колонкою. Уточніть, будь ласка, таблицю чи атрибут.",
+        "pl": "Nie mogę dopasować tego zapytania do żadnej znanej kolumny. Czy możesz wskazać tabelę lub atrybut?",
+    },
+}
+
+
+def _local_decision(route: str, hints: Tuple[str, ...], lang: str) -> dict:
+    msgs = _LOCAL_MSGS[route]
+    template = msgs.get(lang, msgs["en"])
+    return {"route": route, "message": template.format(cols=", ".join(hints[:2]))}
+
+
+# msgspec fuses parse + validate in C and is faster still than orjson;
+# it stays optional, with orjson/json as the fallback codec.
+try:
+    import msgspec
+
+    class RouteDecision(msgspec.Struct):
+        route: str
+        message: str
+
+    _ARGS_DECODER = msgspec.json.Decoder(RouteDecision)
+
+    def _decode_args(raw: str) -> dict:
+        return msgspec.structs.asdict(_ARGS_DECODER.decode(raw))
+except ImportError:
+    def _decode_args(raw: str) -> dict:
+        return orjson.loads(raw)
+
+
+# One keep-alive HTTP/2 pool shared by every LLM request in the process:
+# TCP/TLS handshakes are paid once, not on every pool eviction. h2 is an
+# optional httpx extra; without it fall back to HTTP/1.1 keep-alive.
+try:
+    import h2  # type: ignore  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+_HTTP_CLIENT = httpx.Client(http2=_HTTP2, timeout=30, limits=_HTTP_LIMITS)
+_HTTP_ASYNC_CLIENT = httpx.AsyncClient(http2=_HTTP2, timeout=30, limits=_HTTP_LIMITS)
+
+# ───────── Per-question preparation ─────────
+
+@lru_cache(maxsize=2048)
+def _prepare(question: str) -> Tuple[Tuple[str, ...], Tuple[str, ...], str]:
+    """Tokens, fuzzy hints and language of *question* — computed at most once
+    per process, shared by every router variant."""
+    tokens = _tokenize(question)
+    hints = fuzzy_suggest(question)
+    return tokens, hints, detect(question)